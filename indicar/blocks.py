@@ -0,0 +1,255 @@
+# Indicar Landsat Geoprocessing Tools
+#
+#
+# Author: Hex Gis
+# Contributor: willemarcel
+#
+# License: GPLv3
+
+from __future__ import print_function
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
+
+
+# maximum number of pixels of a window when the raster blocks are strips
+WINDOW_PIXELS = 1024 * 1024
+
+# number of windows read ahead or waiting to be written by the I/O threads
+QUEUE_DEPTH = 2
+
+
+def block_windows(band, max_pixels=WINDOW_PIXELS):
+    """Return the windows (xoff, yoff, xsize, ysize) covering the band in the
+    order of its native blocks. If the blocks are strips as wide as the band,
+    the strips are grouped in windows of up to max_pixels.
+    """
+    xsize = band.XSize
+    ysize = band.YSize
+    block_xsize, block_ysize = band.GetBlockSize()
+
+    if block_xsize >= xsize:
+        block_xsize = xsize
+        strips = (max_pixels // xsize) // block_ysize
+        block_ysize = max(block_ysize, strips * block_ysize)
+    block_ysize = min(block_ysize, ysize)
+
+    return [(x, y, min(block_xsize, xsize - x), min(block_ysize, ysize - y))
+        for y in range(0, ysize, block_ysize)
+        for x in range(0, xsize, block_xsize)]
+
+
+def strip_windows(band, max_pixels=WINDOW_PIXELS):
+    """Return windows as wide as the band, from top to bottom, with a number
+    of lines multiple of the block height and up to max_pixels when possible.
+    """
+    xsize = band.XSize
+    ysize = band.YSize
+    block_ysize = band.GetBlockSize()[1]
+    lines = max(block_ysize, (max_pixels // xsize) // block_ysize * block_ysize)
+    lines = min(lines, ysize)
+
+    return [(0, y, xsize, min(lines, ysize - y)) for y in range(0, ysize, lines)]
+
+
+def new_buffer(windows, dtype):
+    """Allocate a flat array big enough to hold any of the windows."""
+    return numpy.empty(max(w[2] * w[3] for w in windows), dtype)
+
+
+def window_view(buffer, window):
+    """Return a contiguous view of the flat buffer with the window shape."""
+    return buffer[:window[2] * window[3]].reshape(window[3], window[2])
+
+
+class BlockReader(object):
+
+    def __init__(self, bands, dtypes=numpy.float32, windows=None,
+            queue_depth=QUEUE_DEPTH):
+        """Iterate over the windows of bands with the same size, reading them
+        into buffers allocated only once. Each iteration yields the window and
+        a list with a view of each band, which is overwritten after the next
+        iteration. If queue_depth is greater than zero, a thread reads up to
+        queue_depth windows ahead while the current window is processed.
+
+        Arguments:
+        bands - list of GDAL raster bands
+        dtypes - numpy type of the arrays or a list with a type for each band
+        windows - list of windows to read, default is block_windows of the
+            first band
+        queue_depth - number of windows read ahead, zero reads each window
+            only when it is requested
+
+        """
+        if queue_depth < 0:
+            raise ValueError('queue_depth must be 0 or greater')
+        self.bands = bands
+        if windows is None:
+            windows = block_windows(bands[0])
+        self.windows = windows
+        self.queue_depth = queue_depth
+        if not isinstance(dtypes, (list, tuple)):
+            dtypes = [dtypes] * len(bands)
+        # one set of buffers being processed, one being read and the queued ones
+        sets = queue_depth + 2 if queue_depth else 1
+        self.buffer_sets = [[new_buffer(windows, dtype) for dtype in dtypes]
+            for i in range(sets)]
+
+    def __iter__(self):
+        if self.queue_depth:
+            return self.prefetch()
+        return self.iterate()
+
+    def iterate(self):
+        buffers = self.buffer_sets[0]
+        for window in self.windows:
+            yield window, self.read(window, buffers)
+
+    def prefetch(self):
+        free = queue.Queue()
+        for buffers in self.buffer_sets:
+            free.put(buffers)
+        ready = queue.Queue(self.queue_depth)
+        stop = threading.Event()
+
+        def run():
+            try:
+                for window in self.windows:
+                    buffers = free.get()
+                    if buffers is None or stop.is_set():
+                        return
+                    ready.put((window, self.read(window, buffers), buffers))
+                ready.put(None)
+            except Exception as error:
+                ready.put(error)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                window, blocks, buffers = item
+                yield window, blocks
+                free.put(buffers)
+        finally:
+            # stop the thread if the iteration was interrupted
+            stop.set()
+            free.put(None)
+            while thread.is_alive():
+                try:
+                    ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def read(self, window, buffers):
+        """Read the window of each band directly into the buffers."""
+        blocks = []
+        for band, buffer in zip(self.bands, buffers):
+            block = window_view(buffer, window)
+            band.ReadAsArray(window[0], window[1], window[2], window[3],
+                buf_obj=block)
+            blocks.append(block)
+        return blocks
+
+
+class BlockWriter(object):
+
+    def __init__(self, band, windows, dtype=numpy.float32,
+            queue_depth=QUEUE_DEPTH):
+        """Write windows to a band from buffers allocated only once. If
+        queue_depth is greater than zero, the windows are written by a thread
+        and up to queue_depth windows wait to be written. In that case, each
+        window must be written with a buffer given by get_buffer. Use it in a
+        with statement, which closes it after the last window or, if an error
+        is raised, stops the thread discarding the windows not written yet.
+
+        Arguments:
+        band - GDAL raster band
+        windows - list of windows that will be written
+        dtype - numpy type of the buffers
+        queue_depth - number of windows waiting to be written, zero writes
+            each window immediately
+
+        """
+        if queue_depth < 0:
+            raise ValueError('queue_depth must be 0 or greater')
+        self.band = band
+        self.queue_depth = queue_depth
+        self.error = None
+        self.aborted = False
+        if queue_depth:
+            # one buffer being filled, one being written and the queued ones
+            self.free = queue.Queue()
+            for i in range(queue_depth + 2):
+                self.free.put(new_buffer(windows, dtype))
+            self.pending = queue.Queue(queue_depth)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.buffer = new_buffer(windows, dtype)
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            window, block, buffer = item
+            if self.error is None and not self.aborted:
+                try:
+                    self.band.WriteArray(block, window[0], window[1])
+                except Exception as error:
+                    self.error = error
+            self.free.put(buffer)
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def get_buffer(self, window):
+        """Return a view of a free buffer with the window shape."""
+        if self.queue_depth:
+            self.check()
+            self.buffer = self.free.get()
+        return window_view(self.buffer, window)
+
+    def write(self, window, block):
+        if self.queue_depth:
+            self.check()
+            self.pending.put((window, block, self.buffer))
+        else:
+            self.band.WriteArray(block, window[0], window[1])
+
+    def close(self):
+        """Wait until all windows are written and flush the band."""
+        if self.queue_depth:
+            self.pending.put(None)
+            self.thread.join()
+            self.check()
+        self.band.FlushCache()
+
+    def abort(self):
+        """Stop the writer thread without writing the pending windows."""
+        if self.queue_depth:
+            self.aborted = True
+            self.pending.put(None)
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is None:
+            self.close()
+        else:
+            self.abort()
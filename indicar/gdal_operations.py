@@ -8,10 +8,14 @@
 
 from __future__ import print_function
 from subprocess import call
-import struct
+import math
 import sys
 
-from osgeo import gdal
+import numpy
+from osgeo import gdal, gdal_array
+
+from .blocks import (BlockReader, BlockWriter, QUEUE_DEPTH, new_buffer,
+    window_view)
 
 
 class RasterFileIntegrityError(Exception):
@@ -35,9 +39,168 @@ def warp_image(image, bounds, output_file):
     print('Warp image created in %s' % output_file)
 
 
-def subtract(img1, img2, output_file):
+def warp_vrt(image, srs, resolution, output_file, bounds=None):
+    """Create a virtual image of image reprojected to srs with the
+    resolution (xres, yres), optionally clipped to the boundaries
+    coordinates. No pixel is written, the reprojection is done when the
+    virtual image is read. Pixels with value zero are treated as nodata.
+    """
+    args = ['gdalwarp', '-q', '-of', 'VRT', '-r', 'near', '-t_srs', srs,
+        '-tr', '%s' % resolution[0], '%s' % resolution[1],
+        '-srcnodata', '0', '-dstnodata', '0']
+    if bounds:
+        args += ['-te'] + ['%s' % i for i in bounds]
+    call(args + [image, output_file])
+
+
+def calc_difference(img1, img2, result, mask):
+    """Subtract the img2 array from img1 in result. Where any of them is
+    zero, the result is zero. The mask is a boolean array of the same shape
+    used as work space.
+    """
+    numpy.subtract(img1, img2, out=result)
+    numpy.equal(img1, 0, out=mask)
+    numpy.copyto(result, 0, where=mask)
+    numpy.equal(img2, 0, out=mask)
+    numpy.copyto(result, 0, where=mask)
+
+
+def read_decimated(img, factor, dtype=numpy.float32):
+    """Read the first band of img at 1/factor of its resolution, letting GDAL
+    use the overviews of the image when they exist. Return the array and the
+    geotransform and projection of the reduced image.
+    """
+    image = gdal.Open(img, gdal.GA_ReadOnly)
+
+    if image is None:
+        print('The image %s could not be opened' % img)
+        sys.exit(-1)
+
+    xsize = max(1, int(math.ceil(image.RasterXSize / float(factor))))
+    ysize = max(1, int(math.ceil(image.RasterYSize / float(factor))))
+    array = numpy.empty((ysize, xsize), dtype)
+    image.GetRasterBand(1).ReadAsArray(0, 0, image.RasterXSize,
+        image.RasterYSize, xsize, ysize, buf_obj=array)
+
+    xscale = image.RasterXSize / float(xsize)
+    yscale = image.RasterYSize / float(ysize)
+    gt = image.GetGeoTransform()
+    gt = (gt[0], gt[1] * xscale, gt[2] * yscale,
+        gt[3], gt[4] * xscale, gt[5] * yscale)
+
+    return array, gt, image.GetProjection()
+
+
+def read_resampled(img, gt, projection, shape, dtype=numpy.float32):
+    """Read the first band of img reprojected to the grid defined by the
+    geotransform, projection and shape (rows, cols). Pixels outside img
+    are zero.
+    """
+    image = gdal.Open(img, gdal.GA_ReadOnly)
+
+    if image is None:
+        print('The image %s could not be opened' % img)
+        sys.exit(-1)
+
+    grid = gdal.GetDriverByName('MEM').Create('', shape[1], shape[0], 1,
+        gdal_array.NumericTypeCodeToGDALTypeCode(numpy.dtype(dtype).type))
+    grid.SetGeoTransform(gt)
+    grid.SetProjection(projection)
+    gdal.ReprojectImage(image, grid, None, None, gdal.GRA_NearestNeighbour)
+
+    return grid.GetRasterBand(1).ReadAsArray()
+
+
+def write_raster(arrays, gt, projection, output_file, driver_name='GTiff'):
+    """Write the arrays, one for each band, in a new image with the
+    geotransform and projection. The format is given by driver_name.
+    """
+    rows, cols = arrays[0].shape
+    memory = gdal.GetDriverByName('MEM').Create('', cols, rows, len(arrays),
+        gdal_array.NumericTypeCodeToGDALTypeCode(arrays[0].dtype.type))
+    memory.SetGeoTransform(gt)
+    memory.SetProjection(projection)
+    for band, array in enumerate(arrays):
+        memory.GetRasterBand(band + 1).WriteArray(array)
+
+    outDataset = gdal.GetDriverByName(driver_name).CreateCopy(output_file,
+        memory)
+
+    if outDataset is None:
+        print('Could not create output image')
+        sys.exit(-1)
+
+    outDataset = None
+
+
+def change_mask(images, last_images, threshold, output_file,
+        queue_depth=QUEUE_DEPTH):
+    """Subtract each image of last_images from the image of images with the
+    same index and write a Byte mask with 1 where the difference is lower
+    than or equal to the threshold and 0 in the others pixels, in a single
+    pass. All images must have the same grid. Pixels where an image or its
+    last image is zero are skipped. If there are several pairs, each pixel
+    uses the first pair where both images are not zero, so the difference is
+    always calculated between the two dates of the same scene.
+    queue_depth is the number of windows read ahead and written behind.
+    """
+    datasets = [gdal.Open(img, gdal.GA_ReadOnly)
+        for img in list(images) + list(last_images)]
+
+    if any(ds is None for ds in datasets):
+        print('Some of the datasets could not be opened')
+        sys.exit(-1)
+
+    image = datasets[0]
+    reader = BlockReader([ds.GetRasterBand(1) for ds in datasets],
+        queue_depth=queue_depth)
+
+    driver = gdal.GetDriverByName('GTiff')
+    outDataset = driver.Create(output_file, image.RasterXSize,
+        image.RasterYSize, 1, gdal.GDT_Byte)
+
+    if outDataset is None:
+        print('Could not create output image')
+        sys.exit(-1)
+
+    outDataset.SetGeoTransform(image.GetGeoTransform())
+    outDataset.SetProjection(image.GetProjection())
+
+    pairs = len(images)
+    difference = new_buffer(reader.windows, numpy.float32)
+    valid = new_buffer(reader.windows, numpy.bool_)
+    free = new_buffer(reader.windows, numpy.bool_)
+    mask = new_buffer(reader.windows, numpy.bool_)
+    with BlockWriter(outDataset.GetRasterBand(1), reader.windows,
+            numpy.uint8, queue_depth) as writer:
+        for window, blocks in reader:
+            result = writer.get_buffer(window)
+            result.fill(0)
+            # pixels without a pair chosen yet
+            window_free = window_view(free, window)
+            window_free.fill(True)
+            window_valid = window_view(valid, window)
+            window_mask = window_view(mask, window)
+            window_difference = window_view(difference, window)
+            for img_block, last_block in zip(blocks[:pairs], blocks[pairs:]):
+                numpy.not_equal(img_block, 0, out=window_valid)
+                numpy.not_equal(last_block, 0, out=window_mask)
+                numpy.logical_and(window_valid, window_mask, out=window_valid)
+                numpy.logical_and(window_valid, window_free, out=window_valid)
+                numpy.subtract(img_block, last_block, out=window_difference)
+                numpy.less_equal(window_difference, threshold, out=window_mask)
+                numpy.copyto(result, window_mask, where=window_valid)
+                numpy.logical_not(window_valid, out=window_mask)
+                numpy.logical_and(window_free, window_mask, out=window_free)
+            writer.write(window, result)
+
+    print('Change mask created in %s' % output_file)
+
+
+def subtract(img1, img2, output_file, queue_depth=QUEUE_DEPTH):
     """Subtract the img2 from img1. If the pixel value of any
     image is zero, the result of the subtraction will be zero.
+    queue_depth is the number of windows read ahead and written behind.
     """
     image1 = gdal.Open(img1, gdal.GA_ReadOnly)
     image2 = gdal.Open(img2, gdal.GA_ReadOnly)
@@ -48,9 +211,9 @@ def subtract(img1, img2, output_file):
 
     img1_band = image1.GetRasterBand(1)
     img2_band = image2.GetRasterBand(1)
-    numLines = img1_band.YSize
+    reader = BlockReader([img1_band, img2_band], queue_depth=queue_depth)
 
-    driver = image1.GetDriver()
+    driver = gdal.GetDriverByName('GTiff')
     outDataset = driver.Create(output_file, image1.RasterXSize,
         image1.RasterYSize, 1, gdal.GDT_Float32)
     outDataset.SetGeoTransform(image1.GetGeoTransform())
@@ -60,35 +223,22 @@ def subtract(img1, img2, output_file):
         print('Could not create output image')
         sys.exit(-1)
 
-    for line in range(numLines):
-        outputLine = b''
-        img1_scanline = img1_band.ReadRaster(0, line, img1_band.XSize, 1,
-            img1_band.XSize, 1, gdal.GDT_Float32)
-        img1_tuple = struct.unpack('f' * img1_band.XSize, img1_scanline)
-
-        img2_scanline = img2_band.ReadRaster(0, line, img2_band.XSize, 1,
-            img2_band.XSize, 1, gdal.GDT_Float32)
-        img2_tuple = struct.unpack('f' * img2_band.XSize, img2_scanline)
-
-        for i in range(len(img1_tuple)):
-            if img1_tuple[i] == 0 or img2_tuple[i] == 0:
-                result = 0
-            else:
-                result = img1_tuple[i] - img2_tuple[i]
-
-            outputLine = outputLine + struct.pack('f', result)
-
-        outDataset.GetRasterBand(1).WriteRaster(0, line, img1_band.XSize, 1,
-            outputLine, buf_xsize=img1_band.XSize, buf_ysize=1,
-            buf_type=gdal.GDT_Float32)
-        del outputLine
+    nodata = new_buffer(reader.windows, numpy.bool_)
+    with BlockWriter(outDataset.GetRasterBand(1), reader.windows,
+            queue_depth=queue_depth) as writer:
+        for window, (img1_block, img2_block) in reader:
+            result = writer.get_buffer(window)
+            calc_difference(img1_block, img2_block, result,
+                window_view(nodata, window))
+            writer.write(window, result)
 
     print('Difference image created in %s' % output_file)
 
 
-def mask_image(img, threshold, output_file):
+def mask_image(img, threshold, output_file, queue_depth=QUEUE_DEPTH):
     """Read an image and generates a mask with 1 where the pixel value is lower
     than the threshold and zero where it is greater.
+    queue_depth is the number of windows read ahead and written behind.
     """
     image = gdal.Open(img, gdal.GA_ReadOnly)
 
@@ -97,10 +247,9 @@ def mask_image(img, threshold, output_file):
         sys.exit(-1)
 
     image_band = image.GetRasterBand(1)
+    reader = BlockReader([image_band], queue_depth=queue_depth)
 
-    numLines = image_band.YSize
-
-    driver = image.GetDriver()
+    driver = gdal.GetDriverByName('GTiff')
     outDataset = driver.Create(output_file, image.RasterXSize,
         image.RasterYSize, 1, gdal.GDT_Float32)
     outDataset.SetGeoTransform(image.GetGeoTransform())
@@ -110,23 +259,11 @@ def mask_image(img, threshold, output_file):
         print('Could not create output image')
         sys.exit(-1)
 
-    for line in range(numLines):
-        outputLine = b''
-        image_scanline = image_band.ReadRaster(0, line, image_band.XSize, 1,
-            image_band.XSize, 1, gdal.GDT_Float32)
-        image_tuple = struct.unpack('f' * image_band.XSize, image_scanline)
-
-        for i in range(len(image_tuple)):
-            if image_tuple[i] <= threshold:
-                value = 1
-            else:
-                value = 0
-
-            outputLine = outputLine + struct.pack('f', value)
-
-        outDataset.GetRasterBand(1).WriteRaster(0, line, image_band.XSize, 1,
-            outputLine, buf_xsize=image_band.XSize, buf_ysize=1,
-            buf_type=gdal.GDT_Float32)
-        del outputLine
+    with BlockWriter(outDataset.GetRasterBand(1), reader.windows,
+            queue_depth=queue_depth) as writer:
+        for window, (image_block,) in reader:
+            result = writer.get_buffer(window)
+            numpy.less_equal(image_block, threshold, out=result)
+            writer.write(window, result)
 
     print('Mask image created in %s' % output_file)
@@ -10,10 +10,16 @@
 
 from __future__ import print_function
 import argparse
+import os
 import textwrap
 import sys
 
-from .process import Process
+from .blocks import QUEUE_DEPTH
+from .jobqueue import (HEARTBEAT, POLL_INTERVAL, STALE_TIMEOUT, STATES,
+    JobQueue, Worker)
+from .mosaic import Mosaic
+from .mtl import flatten, read_mtl
+from .process import Process, get_metadata
 
 
 DESCRIPTION = """indicar-tools is the software made by the Indicar Project
@@ -33,6 +39,34 @@ to process Landsat imagery.
         use others bands, add the parameter -b or --bands:
         $ indicar process path -b 432
 
+        Mosaic: creates a single change detection file of adjacent scenes of
+        the same cycle, without duplicating the areas where the scenes overlap.
+        Where the scenes overlap, the first scenes have priority.
+        $ indicar mosaic path1 path2 path3 --polygonize
+
+        Scenes: lists the scene id, acquisition date, path/row and cloud cover
+        of the MTL files found in the folders. The parsed MTL files are
+        cached in .cache.json files beside them. Use --max-cloud to list
+        only the scenes with less clouds. The same parameter skips cloudy
+        images in the process command.
+        $ indicar scenes ~/landsat --max-cloud 20
+        $ indicar process path --max-cloud 20
+
+        Queue: distributes the processing among several nodes that share a
+        directory. The scenes are submitted to a job queue in the shared
+        directory and each node runs workers that process them. The change
+        detection of a scene waits for the NDVI of 16 days ago, if that scene
+        is also in the queue.
+        $ indicar queue submit queue_dir path1 path2 --dir landsat_dir
+        $ indicar queue work queue_dir
+        $ indicar queue status queue_dir
+
+        Stats: writes the pixel count, area in hectares, bounding box and
+        centroid of each area of change in a CSV or JSON file, without
+        creating polygons. The areas can be aggregated by a zone raster or
+        polygon layer. Works with process and mosaic.
+        $ indicar process path --stats csv --zones zones.shp --zone-field id
+
     Options:
         RGB: creates only a RGB image, using the bands 6, 5 and 4. This composition
         gives emphasys to the areas without vegetation.
@@ -42,13 +76,31 @@ to process Landsat imagery.
         the pixel value will be 0.
         $ indicar process --ndvi path
 
+        Preview: creates only a quick look of the composition, NDVI and
+        change detection at a reduced resolution, reading the bands with
+        decimation. Useful to check a scene before the full processing.
+        $ indicar process --preview 8 path
+
         Set Directory: by default, indicar-tools will save the processed images
         in a folder named 'landsat' on your home dir, but you can set an
         alternative directory using the --dir parameter.
         $ indicar process path --dir directory_path
+
+        Queue Depth: the rasters are read ahead and written behind the
+        processing by background threads. The --queue-depth parameter sets
+        how many windows can wait in each queue, 0 disables the threads.
+        $ indicar process path --queue-depth 4
 """
 
 
+def queue_depth(value):
+    """Argument type of --queue-depth: an integer equal or greater than 0."""
+    depth = int(value)
+    if depth < 0:
+        raise argparse.ArgumentTypeError('the queue depth must be 0 or greater')
+    return depth
+
+
 def args_options():
     parser = argparse.ArgumentParser(prog='indicar',
                         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -60,33 +112,173 @@ def args_options():
     parser_process.add_argument('path',
                                 help="""Path to the compressed Landsat file or to
                                 a folder containing the uncompressed files.""")
+    parser_process.add_argument('--max-cloud', type=float, metavar='PERCENT',
+                                help="""Skip the image if its cloud cover is
+                                greater than PERCENT.""")
     parser_process.add_argument('--compose', action='store_true',
                                 help='Create only an image composition.')
     parser_process.add_argument('--ndvi', action='store_true',
                                 help='Create only a NDVI from the imagery.')
+    parser_process.add_argument('--preview', type=int, metavar='FACTOR',
+                                help="""Create only a quick look of the
+                                composition, NDVI and change detection at
+                                1/FACTOR of the resolution, e.g. 4 to 16.""")
     parser_process.add_argument('--polygonize', action='store_true',
                                 help="""When calculating change_detection,
                                 polygonize the result generating a geojson file,
                                 instead of a TIF image.""")
+    parser_process.add_argument('--stats', choices=['csv', 'json'],
+                                help="""Write the pixel count, area in hectares,
+                                bounding box and centroid of each area of change
+                                in a CSV or JSON file.""")
+    parser_process.add_argument('--zones',
+                                help="""Raster or polygon layer used to aggregate
+                                the statistics by zone.""")
+    parser_process.add_argument('--zone-field',
+                                help="""Integer field that identifies the zones of
+                                a polygon layer.""")
     parser_process.add_argument('-d', '--dir',
                                 help='Directory where the processed images will be stored.')
     parser_process.add_argument('-b', '--bands',
                                 help="""Bands that will be used to the image
                                 composition. Default value is 654.
                                 """)
+    parser_process.add_argument('-q', '--queue-depth', type=queue_depth,
+                                default=QUEUE_DEPTH,
+                                help="""Number of raster windows read ahead and
+                                written behind the processing. Use 0 to
+                                disable the I/O threads. Default value is %s.
+                                """ % QUEUE_DEPTH)
+    parser_mosaic = subparsers.add_parser('mosaic',
+                                          help="""Detect changes in a mosaic of
+                                          Landsat scenes""")
+    parser_mosaic.add_argument('paths', nargs='+',
+                               help="""Paths to the compressed Landsat files or
+                               to folders containing the uncompressed files.
+                               Where the scenes overlap, the first ones have
+                               priority.""")
+    parser_mosaic.add_argument('--polygonize', action='store_true',
+                               help="""Polygonize the result generating a
+                               geojson file, instead of a TIF image.""")
+    parser_mosaic.add_argument('--stats', choices=['csv', 'json'],
+                               help="""Write the pixel count, area in hectares,
+                               bounding box and centroid of each area of change
+                               in a CSV or JSON file.""")
+    parser_mosaic.add_argument('--zones',
+                               help="""Raster or polygon layer used to aggregate
+                               the statistics by zone.""")
+    parser_mosaic.add_argument('--zone-field',
+                               help="""Integer field that identifies the zones of
+                               a polygon layer.""")
+    parser_mosaic.add_argument('-d', '--dir',
+                               help='Directory where the mosaic detection will be stored.')
+    parser_mosaic.add_argument('-n', '--name',
+                               help="""Name of the mosaic files. Default is
+                               mosaic_ plus the date of the first scene.""")
+    parser_mosaic.add_argument('-q', '--queue-depth', type=queue_depth,
+                               default=QUEUE_DEPTH,
+                               help="""Number of raster windows read ahead and
+                               written behind the processing. Use 0 to disable
+                               the I/O threads. Default value is %s.
+                               """ % QUEUE_DEPTH)
+    parser_scenes = subparsers.add_parser('scenes',
+                                          help="""List the Landsat scenes found
+                                          in folders""")
+    parser_scenes.add_argument('dirs', nargs='+',
+                               help='Folders where the MTL files are searched.')
+    parser_scenes.add_argument('--max-cloud', type=float, metavar='PERCENT',
+                               help="""List only the scenes with cloud cover
+                               lower or equal than PERCENT.""")
+    parser_queue = subparsers.add_parser('queue',
+                                         help="""Process Landsat imagery in
+                                         several nodes using a job queue in a
+                                         shared directory""")
+    queue_subparsers = parser_queue.add_subparsers(help='Queue actions',
+                                                   dest='action')
+    parser_submit = queue_subparsers.add_parser('submit',
+                                                help='Add scenes to the queue')
+    parser_submit.add_argument('queue', help='Directory of the job queue.')
+    parser_submit.add_argument('paths', nargs='+',
+                               help="""Paths to the compressed Landsat files or
+                               to folders containing the uncompressed files.""")
+    parser_submit.add_argument('-d', '--dir',
+                               help="""Directory where the compressed files
+                               will be extracted.""")
+    parser_submit.add_argument('-b', '--bands',
+                               help="""Bands that will be used to the image
+                               composition. Default value is 654.""")
+    parser_submit.add_argument('--polygonize', action='store_true',
+                               help="""Polygonize the change detection
+                               generating a geojson file.""")
+    parser_submit.add_argument('--stats', choices=['csv', 'json'],
+                               help="""Write the statistics of each area of
+                               change in a CSV or JSON file.""")
+    parser_submit.add_argument('--zones',
+                               help="""Raster or polygon layer used to aggregate
+                               the statistics by zone.""")
+    parser_submit.add_argument('--zone-field',
+                               help="""Integer field that identifies the zones of
+                               a polygon layer.""")
+    parser_submit.add_argument('-q', '--queue-depth', type=queue_depth,
+                               default=QUEUE_DEPTH,
+                               help="""Number of raster windows read ahead and
+                               written behind the processing.""")
+    parser_work = queue_subparsers.add_parser('work',
+                                              help='Run the jobs of the queue')
+    parser_work.add_argument('queue', help='Directory of the job queue.')
+    parser_work.add_argument('--once', action='store_true',
+                             help="""Exit when no job is ready instead of
+                             waiting until the queue is empty.""")
+    parser_work.add_argument('--worker-id',
+                             help='Unique name of the worker. Default is hostname-pid.')
+    parser_work.add_argument('--heartbeat', type=float, default=HEARTBEAT,
+                             help="""Seconds between the heartbeats of the
+                             running job. Default value is %s.""" % HEARTBEAT)
+    parser_work.add_argument('--timeout', type=float, default=STALE_TIMEOUT,
+                             help="""Seconds without heartbeat after which a
+                             job is claimed again. Default value is %s.
+                             """ % STALE_TIMEOUT)
+    parser_work.add_argument('--poll', type=float, default=POLL_INTERVAL,
+                             help="""Seconds waited when no job is ready.
+                             Default value is %s.""" % POLL_INTERVAL)
+    parser_status = queue_subparsers.add_parser('status',
+                                                help='Show the jobs of the queue')
+    parser_status.add_argument('queue', help='Directory of the job queue.')
 
     return parser
 
 
+def find_mtl_files(dirs):
+    """Return the paths of the MTL files inside the folders, sorted."""
+    mtl_files = []
+    for folder in dirs:
+        for root, subdirs, files in os.walk(folder):
+            mtl_files += [os.path.join(root, f) for f in files
+                if f.endswith('_MTL.txt')]
+    return sorted(mtl_files)
+
+
 def main(args):
     """Main function - launches the program"""
     if args:
         if args.subs == 'process':
-            if args.dir:
-                p = Process(args.path, args.dir)
-            else:
-                p = Process(args.path)
-            if args.compose:
+            if args.preview is not None and args.preview < 2:
+                exit('The preview factor must be 2 or greater', 1)
+            if args.max_cloud is not None:
+                # checked before Process extracts the compressed file
+                metadata = get_metadata(args.path, args.dir) or {}
+                cloud_cover = metadata.get('CLOUD_COVER')
+                if cloud_cover is not None and cloud_cover > args.max_cloud:
+                    exit('%s was skipped because its cloud cover is %s%%'
+                        % (args.path, cloud_cover))
+            p = Process(args.path, args.dir, args.queue_depth)
+            if args.preview is not None:
+                if args.bands:
+                    bands = [int(b) for b in args.bands if b.isdigit()]
+                    p.preview(args.preview, bands)
+                else:
+                    p.preview(args.preview)
+            elif args.compose:
                 if args.bands:
                     bands = [int(b) for b in args.bands if b.isdigit()]
                     p.make_img(bands)
@@ -97,9 +289,49 @@ def main(args):
             else:
                 if args.bands:
                     bands = [int(b) for b in args.bands if b.isdigit()]
-                    p.full(bands, args.polygonize)
+                    p.full(bands, args.polygonize, args.stats, args.zones,
+                        args.zone_field)
                 else:
-                    p.full(polygonize=args.polygonize)
+                    p.full(polygonize=args.polygonize, stats=args.stats,
+                        zones=args.zones, zone_field=args.zone_field)
+        elif args.subs == 'mosaic':
+            m = Mosaic(args.paths, args.dir, args.name, args.queue_depth)
+            m.full(args.polygonize, args.stats, args.zones, args.zone_field)
+        elif args.subs == 'scenes':
+            for mtl in find_mtl_files(args.dirs):
+                metadata = flatten(read_mtl(mtl))
+                cloud_cover = metadata.get('CLOUD_COVER')
+                if (args.max_cloud is not None and cloud_cover is not None and
+                        cloud_cover > args.max_cloud):
+                    continue
+                print('%s  %s  %03d/%03d  %s%%' % (
+                    metadata.get('LANDSAT_SCENE_ID'),
+                    metadata.get('DATE_ACQUIRED'),
+                    metadata.get('WRS_PATH', 0), metadata.get('WRS_ROW', 0),
+                    cloud_cover))
+        elif args.subs == 'queue':
+            if args.action == 'submit':
+                options = {'polygonize': args.polygonize, 'stats': args.stats,
+                    'zone_field': args.zone_field,
+                    'queue_depth': args.queue_depth}
+                if args.bands:
+                    options['bands'] = [int(b) for b in args.bands if b.isdigit()]
+                if args.zones:
+                    options['zones'] = os.path.abspath(args.zones)
+                jobs = JobQueue(args.queue).submit(args.paths, args.dir, options)
+                print('%s jobs submitted' % len(jobs))
+            elif args.action == 'work':
+                w = Worker(args.queue, args.worker_id, args.heartbeat,
+                    args.timeout, args.poll)
+                count = w.run(not args.once)
+                print('Worker %s executed %s jobs' % (w.id, count))
+            elif args.action == 'status':
+                q = JobQueue(args.queue)
+                for state in STATES:
+                    jobs = q.list(state)
+                    print('%s: %s' % (state, len(jobs)))
+                    for job_id in jobs:
+                        print('    %s' % job_id)
 
 
 def exit(message, code=0):
@@ -0,0 +1,373 @@
+# Indicar Landsat Geoprocessing Tools
+#
+#
+# Author: Hex Gis
+# Contributor: willemarcel
+#
+# License: GPLv3
+
+from __future__ import print_function
+from shutil import copy2, rmtree
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+from .blocks import QUEUE_DEPTH
+from .process import (Process, check_create_folder, get_file,
+    get_last_image_name)
+
+
+STATES = ['pending', 'running', 'done', 'failed']
+
+# folder with an empty file for each job ever submitted to the queue
+SUBMITTED = 'submitted'
+
+# seconds between the heartbeats of a running job
+HEARTBEAT = 30
+
+# seconds without heartbeat after which a running job is claimed again
+STALE_TIMEOUT = 600
+
+# seconds a worker waits before looking again for jobs ready to run
+POLL_INTERVAL = 10
+
+
+def write_json(path, data):
+    """Write data to path atomically, renaming a temporary file."""
+    tmp = '%s.%s-%s.tmp' % (path, socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.rename(tmp, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def publish(src_dir, dst_dir):
+    """Move the regular files of src_dir to dst_dir. Each file appears in
+    dst_dir at once, even if the directories are in different filesystems.
+    """
+    check_create_folder(dst_dir)
+    for name in os.listdir(src_dir):
+        src = os.path.join(src_dir, name)
+        if os.path.islink(src) or not os.path.isfile(src):
+            continue
+        dst = os.path.join(dst_dir, name)
+        try:
+            os.rename(src, dst)
+        except OSError:
+            tmp = '%s.%s-%s.tmp' % (dst, socket.gethostname(), os.getpid())
+            copy2(src, tmp)
+            os.rename(tmp, dst)
+            os.remove(src)
+
+
+def link_files(src_dir, dst_dir, patterns):
+    """Create in dst_dir symbolic links to the files of src_dir that match
+    the glob patterns.
+    """
+    check_create_folder(dst_dir)
+    for pattern in patterns:
+        for src in glob.glob(os.path.join(src_dir, pattern)):
+            os.symlink(os.path.abspath(src),
+                os.path.join(dst_dir, os.path.basename(src)))
+
+
+class JobQueue(object):
+
+    def __init__(self, path):
+        """Initialize a job queue stored in the path directory, which can be
+        shared by several nodes. Each job is a JSON file moved between the
+        pending, running, done and failed folders. A job is claimed renaming
+        it from pending to running with the worker id in the file name, so
+        only one worker gets it. Running jobs are touched by the worker as a
+        heartbeat. The ids of the submitted jobs are kept apart, because a
+        job being moved between folders is briefly found in none of them.
+        """
+        self.path = path
+        for state in STATES + [SUBMITTED, 'staging']:
+            check_create_folder(os.path.join(path, state))
+
+    def job_file(self, state, job_id, worker=None):
+        if worker:
+            job_id = '%s@%s' % (job_id, worker)
+        return os.path.join(self.path, state, job_id + '.json')
+
+    def list(self, state):
+        """Return the ids of the jobs in state, sorted."""
+        files = glob.glob(os.path.join(self.path, state, '*.json'))
+        return sorted(get_file(f)[:-5].split('@')[0] for f in files)
+
+    def state(self, job_id):
+        """Return the state of the job or None if it's not in the queue."""
+        for state in STATES:
+            worker = '*' if state == 'running' else None
+            if glob.glob(self.job_file(state, job_id, worker)):
+                return state
+        return None
+
+    def is_submitted(self, job_id):
+        return os.path.isfile(os.path.join(self.path, SUBMITTED, job_id))
+
+    def submit(self, paths, base_dir=None, options=None):
+        """Add to the queue a scene job, which makes the image composition and
+        the NDVI, and a detection job of each path. The detection job runs
+        after the scene job and the scene job of 16 days ago, if it's in the
+        queue. Return the ids of the new jobs.
+
+        Arguments:
+        paths - paths of the compressed Landsat files or folders
+        base_dir - directory where the compressed files will be extracted
+        options - dict with the bands, polygonize, stats, zones, zone_field
+            and queue_depth options of Process
+
+        """
+        if not base_dir:
+            base_dir = os.path.join(os.path.expanduser('~'), 'landsat')
+        options = options or {}
+        submitted = []
+        for path in paths:
+            path = os.path.abspath(path.rstrip('/'))
+            image = get_file(path).split('.')[0]
+            if path.endswith('.tar.gz'):
+                folder = os.path.join(os.path.abspath(base_dir), image)
+            else:
+                folder = path
+            jobs = [
+                {'id': image, 'kind': 'scene', 'image': image, 'path': path,
+                    'folder': folder, 'requires': [], 'options': options},
+                {'id': image + '_detection', 'kind': 'detection', 'image': image,
+                    'path': path, 'folder': folder,
+                    'requires': [image, get_last_image_name(image)],
+                    'options': options}
+                ]
+            for job in jobs:
+                if not self.is_submitted(job['id']):
+                    open(os.path.join(self.path, SUBMITTED, job['id']),
+                        'w').close()
+                    write_json(self.job_file('pending', job['id']), job)
+                    submitted.append(job['id'])
+        return submitted
+
+    def is_ready(self, job):
+        """A job is ready when the jobs it requires are finished or were never
+        submitted to the queue.
+        """
+        for job_id in job['requires']:
+            if self.is_submitted(job_id):
+                if self.state(job_id) not in ('done', 'failed'):
+                    return False
+        return True
+
+    def now(self, worker):
+        """Return the current time of the filesystem, touching a file, so
+        the clocks of the nodes don't need to be synchronized.
+        """
+        clock = os.path.join(self.path, 'staging', worker + '.clock')
+        open(clock, 'w').close()
+        return os.path.getmtime(clock)
+
+    def reclaim(self, worker, timeout=STALE_TIMEOUT):
+        """Move back to pending the running jobs without heartbeat for more
+        than timeout seconds.
+        """
+        now = self.now(worker)
+        for job_file in glob.glob(os.path.join(self.path, 'running', '*.json')):
+            try:
+                if now - os.path.getmtime(job_file) < timeout:
+                    continue
+                job_id = get_file(job_file)[:-5].split('@')[0]
+                os.rename(job_file, self.job_file('pending', job_id))
+                print('Job %s reclaimed from a stale worker' % job_id)
+            except OSError:
+                # the job was finished or reclaimed by another worker
+                pass
+
+    def claim(self, worker, timeout=STALE_TIMEOUT):
+        """Claim the first pending job that is ready. Return the job and the
+        path of its running file, or None if there is no job ready.
+        """
+        self.reclaim(worker, timeout)
+        for job_id in self.list('pending'):
+            try:
+                job = read_json(self.job_file('pending', job_id))
+            except (IOError, OSError, ValueError):
+                continue
+            if not self.is_ready(job):
+                continue
+            pending = self.job_file('pending', job_id)
+            running = self.job_file('running', job_id, worker)
+            try:
+                # the rename keeps the mtime of the submit, touch it first so
+                # the job isn't stale before the first heartbeat
+                os.utime(pending, None)
+                os.rename(pending, running)
+            except OSError:
+                continue
+            return job, running
+        return None
+
+    def finish(self, job, running, error=None):
+        """Move the running job to done or, if there is an error, to failed.
+        Return False if the job was reclaimed by another worker meanwhile.
+        """
+        state = 'done'
+        if error is not None:
+            state = 'failed'
+            job['error'] = error
+        job_file = self.job_file(state, job['id'])
+        try:
+            os.rename(running, job_file)
+        except OSError:
+            return False
+        if error is not None:
+            write_json(job_file, job)
+        return True
+
+    def has_work(self):
+        return bool(self.list('pending') or self.list('running'))
+
+
+class Heartbeat(threading.Thread):
+
+    def __init__(self, path, interval=HEARTBEAT):
+        """Touch path every interval seconds until stop is called. If the
+        file disappears, lost becomes True.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.lost = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Worker(object):
+
+    def __init__(self, queue_path, worker_id=None, heartbeat=HEARTBEAT,
+            timeout=STALE_TIMEOUT, poll=POLL_INTERVAL):
+        """Initialize a worker of the job queue in queue_path. Several workers,
+        in the same or in other nodes, can run on the same queue.
+
+        Arguments:
+        queue_path - directory of the job queue
+        worker_id - unique name of the worker, default is hostname-pid
+        heartbeat - seconds between the heartbeats of the running job
+        timeout - seconds without heartbeat after which a job is reclaimed
+        poll - seconds waited when no job is ready
+
+        """
+        self.queue = JobQueue(queue_path)
+        self.id = worker_id or '%s-%s' % (socket.gethostname(), os.getpid())
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.poll = poll
+
+    def run(self, wait=True):
+        """Run jobs until the queue has no pending or running jobs. If wait is
+        False, return as soon as no job is ready. Return the number of jobs
+        executed.
+        """
+        count = 0
+        try:
+            while True:
+                claimed = self.queue.claim(self.id, self.timeout)
+                if claimed is None:
+                    if not wait or not self.queue.has_work():
+                        return count
+                    time.sleep(self.poll)
+                    continue
+                self.execute(*claimed)
+                count += 1
+        finally:
+            staging = os.path.join(self.queue.path, 'staging', self.id)
+            for path in [staging, staging + '.clock']:
+                if os.path.isdir(path):
+                    rmtree(path)
+                elif os.path.isfile(path):
+                    os.remove(path)
+
+    def execute(self, job, running):
+        """Run the job in a staging folder and publish the files created in
+        the scene folder, while a heartbeat keeps the job claimed.
+        """
+        print('Worker %s running job %s' % (self.id, job['id']))
+        # the staging path must not contain the image name, because Process
+        # finds the folder of 16 days ago replacing it in the path
+        staging = os.path.join(self.queue.path, 'staging', self.id, job['kind'])
+        if os.path.isdir(staging):
+            rmtree(staging)
+        heartbeat = Heartbeat(running, self.heartbeat)
+        heartbeat.start()
+        error = None
+        try:
+            scene_dir = self.run_job(job, staging)
+            if heartbeat.lost:
+                print('Job %s was reclaimed, its result was discarded' % job['id'])
+                return
+            publish(scene_dir, job['folder'])
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+        finally:
+            heartbeat.stop()
+            if os.path.isdir(staging):
+                rmtree(staging)
+
+        if not self.queue.finish(job, running, error):
+            print('Job %s was reclaimed by another worker' % job['id'])
+        elif error is None:
+            print('Job %s done' % job['id'])
+        else:
+            print('Job %s failed' % job['id'])
+
+    def run_job(self, job, staging):
+        """Process the job in staging, linking only the input files, and
+        return the folder with the created files.
+        """
+        options = job['options']
+        image = job['image']
+        scene_dir = os.path.join(staging, image)
+        queue_depth = options.get('queue_depth', QUEUE_DEPTH)
+
+        if job['kind'] == 'scene':
+            if job['path'].endswith('.tar.gz'):
+                p = Process(job['path'], staging, queue_depth)
+            else:
+                link_files(job['folder'], scene_dir,
+                    [image + '_B*.TIF', image + '_MTL.txt'])
+                p = Process(scene_dir, queue_depth=queue_depth)
+            p.make_img(options.get('bands') or [6, 5, 4])
+            if not p.make_ndvi():
+                raise RuntimeError('NDVI of %s could not be created' % image)
+        else:
+            last_image = get_last_image_name(image)
+            link_files(job['folder'], scene_dir, [image + '_ndvi.tif'])
+            link_files(os.path.join(os.path.dirname(job['folder']), last_image),
+                os.path.join(staging, last_image), [last_image + '_ndvi.tif'])
+            p = Process(scene_dir, queue_depth=queue_depth)
+            if not p.change_detection(options.get('polygonize', False),
+                    options.get('stats'), options.get('zones'),
+                    options.get('zone_field')):
+                raise RuntimeError('Change detection of %s could not be created'
+                    % image)
+
+        return scene_dir
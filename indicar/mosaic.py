@@ -0,0 +1,133 @@
+# Indicar Landsat Geoprocessing Tools
+#
+#
+# Author: Hex Gis
+# Contributor: willemarcel
+#
+# License: GPLv3
+
+from __future__ import print_function
+import os
+
+from osgeo import gdal
+
+from .blocks import QUEUE_DEPTH
+from .gdal_operations import warp_vrt
+from .process import (Process, check_create_folder, detect_changes,
+    get_image_bounds)
+
+
+def get_union_bounds(images):
+    """Return the bounds [minx, miny, maxx, maxy] covering all the images."""
+    bounds = [get_image_bounds(image) for image in images]
+
+    return [min(b[0][0] for b in bounds), min(b[0][1] for b in bounds),
+        max(b[1][0] for b in bounds), max(b[1][1] for b in bounds)]
+
+
+class Mosaic(object):
+
+    def __init__(self, paths, base_dir=None, name=None,
+            queue_depth=QUEUE_DEPTH):
+        """Initialize the Mosaic class
+
+        Arguments:
+        paths - list of paths of Landsat folders or compressed files of the same
+            cycle. Where the scenes overlap, the first scenes of the list have
+            priority over the next ones. Scenes in other projections are
+            reprojected to the projection of the first scene.
+        base_dir - directory where the mosaic detection will be stored
+        name - prefix of the mosaic files, default is mosaic_ plus the year and
+            julian day of the first scene
+        queue_depth - number of raster windows read ahead and written behind
+            the processing, zero disables the I/O threads
+
+        """
+        self.queue_depth = queue_depth
+        self.scenes = [Process(path, base_dir, queue_depth) for path in paths]
+
+        if not base_dir:
+            base_dir = os.path.join(os.path.expanduser('~'), 'landsat')
+        self.dst_path = check_create_folder(base_dir)
+
+        if name:
+            self.name = name
+        else:
+            self.name = 'mosaic_%s' % self.scenes[0].image[9:16]
+
+    def full(self, polygonize=False, stats=None, zones=None, zone_field=None):
+        """Make the NDVI of the scenes that don't have it yet and the change
+        detection of the mosaic.
+        """
+        for scene in self.scenes:
+            if not os.path.isfile(scene.ndvi):
+                scene.make_ndvi()
+        return self.change_detection(polygonize, stats, zones, zone_field)
+
+    def change_detection(self, polygonize=False, stats=None, zones=None,
+            zone_field=None):
+        """Make a single change detection of all scenes. The NDVI of each
+        scene and its NDVI of 16 days ago are reprojected to virtual images
+        with the projection and resolution of the first scene, clipped to the
+        area covered by both cycles, so the change detection reads the scenes
+        directly and no mosaic image is created. Each pixel is compared using
+        the first scene whose two NDVIs are valid there (not zero), so the
+        difference is always between two dates of the same scene. Scenes
+        without the current or the last NDVI are left out. The stats, zones
+        and zone_field arguments are the same of Process.change_detection.
+        """
+        ndvis = []
+        last_ndvis = []
+        for scene in self.scenes:
+            last_ndvi = scene.get_last_ndvi()
+            if os.path.isfile(scene.ndvi) and os.path.isfile(last_ndvi):
+                ndvis.append(scene.ndvi)
+                last_ndvis.append(last_ndvi)
+            else:
+                print('%s was left out of the mosaic because some NDVI image is missing.'
+                    % scene.image)
+
+        if not ndvis:
+            print('Change detection was not executed because there is no scene with both NDVI images.')
+            return False
+
+        first = gdal.Open(ndvis[0], gdal.GA_ReadOnly)
+        srs = first.GetProjection()
+        gt = first.GetGeoTransform()
+        resolution = (abs(gt[1]), abs(gt[5]))
+        first = None
+
+        # reproject all images to find their bounds in the mosaic projection
+        footprints = []
+        for i, image in enumerate(ndvis + last_ndvis):
+            footprint = os.path.join(self.dst_path,
+                '%s_footprint_%s.vrt' % (self.name, i))
+            warp_vrt(image, srs, resolution, footprint)
+            footprints.append(footprint)
+        bounds = get_union_bounds(footprints[:len(ndvis)])
+        last_bounds = get_union_bounds(footprints[len(ndvis):])
+        bounds = [max(bounds[0], last_bounds[0]), max(bounds[1], last_bounds[1]),
+            min(bounds[2], last_bounds[2]), min(bounds[3], last_bounds[3])]
+
+        # virtual images of every scene with the same grid
+        ndvi_vrts = []
+        last_ndvi_vrts = []
+        for i, (ndvi, last_ndvi) in enumerate(zip(ndvis, last_ndvis)):
+            ndvi_vrt = os.path.join(self.dst_path,
+                '%s_ndvi_%s.vrt' % (self.name, i))
+            last_ndvi_vrt = os.path.join(self.dst_path,
+                '%s_last_ndvi_%s.vrt' % (self.name, i))
+            warp_vrt(ndvi, srs, resolution, ndvi_vrt, bounds)
+            warp_vrt(last_ndvi, srs, resolution, last_ndvi_vrt, bounds)
+            ndvi_vrts.append(ndvi_vrt)
+            last_ndvi_vrts.append(last_ndvi_vrt)
+
+        result_file = detect_changes(ndvi_vrts, last_ndvi_vrts, self.dst_path,
+            self.name, polygonize, self.queue_depth, stats, zones, zone_field)
+
+        for f in footprints + ndvi_vrts + last_ndvi_vrts:
+            if os.path.isfile(f):
+                os.remove(f)
+
+        print('Mosaic change detection created in %s' % result_file)
+        return result_file
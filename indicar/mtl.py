@@ -0,0 +1,148 @@
+# Indicar Landsat Geoprocessing Tools
+#
+#
+# Author: Hex Gis
+# Contributor: willemarcel
+#
+# License: GPLv3
+
+from __future__ import print_function
+from datetime import date, datetime
+import json
+import os
+import re
+import tarfile
+
+
+DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+DATETIME = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z$')
+
+# version of the cache format, change it when the parsed values change
+CACHE_VERSION = 1
+
+
+def parse_value(value):
+    """Convert a MTL value to str, int, float, date or datetime. Times and
+    other unquoted values are returned as str.
+    """
+    if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if DATE.match(value):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    if DATETIME.match(value):
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+    return value
+
+
+def parse_mtl(lines):
+    """Parse the lines of a MTL file, returning a dict where each GROUP is a
+    dict with its fields and inner groups.
+    """
+    root = {}
+    groups = [root]
+    for line in lines:
+        if '=' not in line:
+            continue
+        key, value = [i.strip() for i in line.split('=', 1)]
+        if key == 'GROUP':
+            group = {}
+            groups[-1][value] = group
+            groups.append(group)
+        elif key == 'END_GROUP':
+            if len(groups) > 1:
+                groups.pop()
+        else:
+            groups[-1][key] = parse_value(value)
+    return root
+
+
+def flatten(metadata):
+    """Return a dict with the fields of all groups of the metadata."""
+    fields = {}
+    for key, value in metadata.items():
+        if isinstance(value, dict):
+            fields.update(flatten(value))
+        else:
+            fields[key] = value
+    return fields
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return {'$datetime': value.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def decode(obj):
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.strptime(obj['$datetime'], '%Y-%m-%dT%H:%M:%SZ')
+    if len(obj) == 1 and '$date' in obj:
+        return datetime.strptime(obj['$date'], '%Y-%m-%d').date()
+    return obj
+
+
+def read_tar_mtl(path):
+    """Return the lines of the MTL file inside a compressed Landsat file,
+    without extracting the other files.
+    """
+    with tarfile.open(path) as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith('_MTL.txt'):
+                return tar.extractfile(member).read().decode('utf-8').splitlines()
+    raise IOError('MTL file not found in %s' % path)
+
+
+def cache_file(mtl):
+    """Return the path of the sidecar file with the parsed metadata."""
+    return mtl + '.cache.json'
+
+
+def read_mtl(mtl, cache=True):
+    """Return the parsed metadata of the MTL file. If cache is True, the
+    metadata is read from a sidecar file when it was created from a MTL file
+    with the same modification time and size, otherwise the MTL is parsed
+    and the sidecar is written, if the folder is writable. mtl can also be
+    a compressed Landsat file (.tar.gz), whose MTL is read without extracting
+    it.
+    """
+    stat = os.stat(mtl)
+    key = [CACHE_VERSION, stat.st_mtime, stat.st_size]
+    sidecar = cache_file(mtl)
+
+    if cache and os.path.isfile(sidecar):
+        try:
+            with open(sidecar) as f:
+                cached = json.load(f, object_hook=decode)
+            if cached['key'] == key:
+                return cached['metadata']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    if mtl.endswith('.tar.gz'):
+        metadata = parse_mtl(read_tar_mtl(mtl))
+    else:
+        with open(mtl) as f:
+            metadata = parse_mtl(f)
+
+    if cache:
+        tmp = '%s.%s.tmp' % (sidecar, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'key': key, 'metadata': metadata}, f,
+                    default=encode, separators=(',', ':'))
+            os.rename(tmp, sidecar)
+        except (IOError, OSError):
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+    return metadata
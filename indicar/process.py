@@ -10,13 +10,60 @@ from __future__ import print_function
 from datetime import date, timedelta
 from subprocess import call
 from shutil import rmtree
-import struct
 import os
+import tarfile
 
+import numpy
 from osgeo import gdal
 
+from .blocks import (BlockReader, BlockWriter, QUEUE_DEPTH, new_buffer,
+    window_view)
 from .gdal_operations import *
+from .mtl import flatten, read_mtl
 from .ref_toa import Landsat8
+from .stats import change_statistics
+
+
+# BQA values that indicate cloud or cirrus
+BQA_VALUES = [61440, 59424, 57344, 56320, 53248, 52256, 52224, 49184, 49152,
+    48128, 45056, 43040, 39936, 36896, 36864, 32768, 31744, 28672]
+
+# lookup table indexed by the BQA value, True where it is cloud or cirrus
+BQA_CLOUD = numpy.zeros(65536, numpy.bool_)
+BQA_CLOUD[BQA_VALUES] = True
+
+
+def calc_ndvi(red, nir, b6, bqa, ndvi, mask):
+    """Calculate the NDVI of the red and nir arrays in the ndvi array. If the
+    bqa value indicates cloud or cirrus, if the b6 value is lower than 0.1 or
+    if the sum of red and nir is zero, the NDVI value will be zero. The mask
+    is a boolean array of the same shape used as work space and the red array
+    is overwritten.
+    """
+    numpy.subtract(nir, red, out=ndvi)
+    numpy.add(nir, red, out=red)
+    numpy.equal(red, 0, out=mask)
+    numpy.copyto(red, 1, where=mask)
+    numpy.copyto(ndvi, 0, where=mask)
+    numpy.divide(ndvi, red, out=ndvi)
+    numpy.less(b6, 0.1, out=mask)
+    numpy.copyto(ndvi, 0, where=mask)
+    numpy.take(BQA_CLOUD, bqa, out=mask, mode='clip')
+    numpy.copyto(ndvi, 0, where=mask)
+
+
+def stretch(array):
+    """Return the array scaled to 8 bits between its 2 and 98 percentiles,
+    ignoring the zero pixels, which remain zero.
+    """
+    valid = array[array != 0]
+    result = numpy.zeros(array.shape, numpy.uint8)
+    if valid.size:
+        low, high = numpy.percentile(valid, [2, 98])
+        scaled = (array - low) * (254.0 / max(high - low, 1)) + 1
+        numpy.clip(scaled, 1, 255, out=scaled)
+        result[array != 0] = scaled[array != 0]
+    return result
 
 
 def check_create_folder(folder_path):
@@ -61,6 +108,41 @@ def get_last_image_name(image):
     return "%s%s%s%s" % (image[:9], last_year, three_digit(last_day), image[16:])
 
 
+def get_image_folder(path, base_dir=None):
+    """Return the name of the image and the folder where its files are or,
+    if path is a compressed file, will be extracted.
+    """
+    path = path.rstrip('/')
+    image = get_file(path).split('.')[0]
+    if path.endswith('.tar.gz'):
+        if not base_dir:
+            base_dir = os.path.join(os.path.expanduser('~'), 'landsat')
+        return image, os.path.join(base_dir, image)
+    elif os.path.isdir(path):
+        return image, path
+    else:
+        return image, os.path.join(os.path.expanduser('~'), 'landsat', path)
+
+
+def get_metadata(path, base_dir=None):
+    """Return a dict with the fields of the MTL file of the Landsat folder or
+    compressed file or None if it's missing. Compressed files are not
+    extracted, so it can be used to filter the images before processing them.
+    The parsed MTL is cached, so it's cheap to call it many times.
+    """
+    path = path.rstrip('/')
+    image, folder = get_image_folder(path, base_dir)
+    mtl = os.path.join(folder, image + '_MTL.txt')
+    if os.path.isfile(mtl):
+        return flatten(read_mtl(mtl))
+    if path.endswith('.tar.gz') and os.path.isfile(path):
+        try:
+            return flatten(read_mtl(path))
+        except (IOError, tarfile.TarError):
+            return None
+    return None
+
+
 def get_image_bounds(image_path):
     """Return the coordinates of the lower left (minx, miny) and the
     upper right (maxx, maxy) of the image.
@@ -96,29 +178,84 @@ def get_intersection_bounds(image1, image2):
     return [minx[1], miny[1], maxx[0], maxy[0]]
 
 
+def detect_changes(ndvis, last_ndvis, folder, name, polygonize=False,
+        queue_depth=QUEUE_DEPTH, stats=None, zones=None, zone_field=None):
+    """Run the change detection chain over lists of NDVI rasters and of the
+    NDVI rasters of 16 days ago, all with the same grid, and return the path
+    of the result file. The files are created in folder, prefixed with name.
+    The steps are:
+        1. Subtract the NDVI images and mask the result in a single pass,
+            putting the value 1 where the difference is less than -0.08 and
+            the value 0 in the others pixels (see change_mask)
+        2. Sieve the image, removing areas lower than 33 pixels
+        3. If stats is 'csv' or 'json', write the statistics of each area of
+            change in a file of that format, aggregated by the optional zones
+            (see change_statistics)
+        4. If polygonize is true:
+            4.1 Polygonize the sieve image creating a Shapefile
+            4.2 Convert the Shapefile to GeoJSON reprojecting it to Sirgas 2000
+    queue_depth is the number of windows read ahead and written behind by
+    change_mask.
+    """
+    changes_mask = os.path.join(folder, name + '_changes_mask.tif')
+    sieve = os.path.join(folder, name + '_detection.tif')
+
+    change_mask(ndvis, last_ndvis, -0.08, changes_mask, queue_depth)
+    # remove areas lower than 33 pixels what represents 30000 sq metres
+    call(['gdal_sieve.py', '-st', '33', changes_mask, sieve])
+    result_file = sieve
+
+    if stats:
+        stats_file = os.path.join(folder, '%s_detection_stats.%s' % (name, stats))
+        change_statistics(sieve, stats_file, zones, zone_field,
+            queue_depth=queue_depth)
+
+    if polygonize is True:
+        # create a folder to shp files because it's more than one file
+        shp_folder = check_create_folder(os.path.join(folder, 'shp'))
+        detection_shp = os.path.join(shp_folder, name + '_detection.shp')
+        detection_geojson = os.path.join(folder, name + '_detection.geojson')
+
+        # polygonize sieve file to shapefile
+        call(['gdal_polygonize.py', sieve, '-f', 'ESRI Shapefile',
+            detection_shp])
+        # convert to GeoJSON, reproject in Sirgas 2000 and filter areas
+        # with DN=1 to get only the areas where the pixel had
+        # value 1 in the changes_mask
+        call(['ogr2ogr', '-where', '"DN"=1', '-t_srs', 'EPSG:4674',
+            '-f', 'GeoJSON', detection_geojson, detection_shp])
+        os.remove(sieve)
+        result_file = detection_geojson
+
+        # remove shp folder
+        rmtree(shp_folder)
+
+    # remove intermediate files
+    if os.path.isfile(changes_mask):
+        os.remove(changes_mask)
+
+    return result_file
+
+
 class Process(object):
 
-    def __init__(self, path, base_dir=None):
+    def __init__(self, path, base_dir=None, queue_depth=QUEUE_DEPTH):
         """Initialize the Process class
 
         Arguments:
         path - string containing the path of the Landsat folder or compressed file
+        base_dir - directory where the compressed file will be extracted
+        queue_depth - number of raster windows read ahead and written behind
+            the processing, zero disables the I/O threads
 
         """
+        self.queue_depth = queue_depth
         path = path.rstrip('/')
-        self.image = get_file(path).split('.')[0]
+        self.image, self.src_image_path = get_image_folder(path, base_dir)
 
         if path.endswith('.tar.gz'):
-            if not base_dir:
-                base_dir = os.path.join(os.path.expanduser('~'), 'landsat')
-            self.src_image_path = os.path.join(base_dir, self.image)
             check_create_folder(self.src_image_path)
             self.extract(path, self.src_image_path)
-        else:
-            if os.path.isdir(path):
-                self.src_image_path = path
-            else:
-                self.src_image_path = os.path.join(os.path.expanduser('~'), 'landsat', path)
 
         self.b4 = os.path.join(self.src_image_path, self.image + '_B4.TIF')
         self.b5 = os.path.join(self.src_image_path, self.image + '_B5.TIF')
@@ -127,13 +264,14 @@ class Process(object):
         self.mtl = os.path.join(self.src_image_path, self.image + '_MTL.txt')
         self.ndvi = os.path.join(self.src_image_path, self.image + '_ndvi.tif')
 
-    def full(self, bands=[6, 5, 4], polygonize=False):
+    def full(self, bands=[6, 5, 4], polygonize=False, stats=None, zones=None,
+            zone_field=None):
         """Make an image composition with the chosen bands, a NDVI composition
         and change_detection.
         """
         self.make_img(bands)
         self.make_ndvi()
-        self.change_detection(polygonize)
+        self.change_detection(polygonize, stats, zones, zone_field)
 
     def extract(self, src, dst):
         """Extract the Landsat file."""
@@ -179,11 +317,9 @@ class Process(object):
             nir_band = b5.GetRasterBand(1)
             b6_band = b6.GetRasterBand(1)
             bqa_band = bqa.GetRasterBand(1)
-            numLines = red_band.YSize
-
-            bqa_values = [61440, 59424, 57344, 56320, 53248, 52256, 52224,
-                49184, 49152, 48128, 45056, 43040, 39936, 36896, 36864, 32768,
-                31744, 28672]
+            reader = BlockReader([red_band, nir_band, b6_band, bqa_band],
+                [numpy.float32, numpy.float32, numpy.float32, numpy.uint16],
+                queue_depth=self.queue_depth)
 
             driver = b4.GetDriver()
             outDataset = driver.Create(self.ndvi, b4.RasterXSize, b4.RasterYSize,
@@ -191,44 +327,15 @@ class Process(object):
             outDataset.SetGeoTransform(b4.GetGeoTransform())
             outDataset.SetProjection(b4.GetProjection())
 
-            for line in range(numLines):
-                outputLine = b''
-                red_scanline = red_band.ReadRaster(0, line, red_band.XSize, 1,
-                    red_band.XSize, 1, gdal.GDT_Float32)
-                red_tuple = struct.unpack('f' * red_band.XSize, red_scanline)
-
-                nir_scanline = nir_band.ReadRaster(0, line, nir_band.XSize, 1,
-                    nir_band.XSize, 1, gdal.GDT_Float32)
-                nir_tuple = struct.unpack('f' * nir_band.XSize, nir_scanline)
-
-                b6_scanline = b6_band.ReadRaster(0, line, b6_band.XSize, 1,
-                    b6_band.XSize, 1, gdal.GDT_Float32)
-                b6_tuple = struct.unpack('f' * b6_band.XSize, b6_scanline)
-
-                bqa_scanline = bqa_band.ReadRaster(0, line, bqa_band.XSize, 1,
-                    bqa_band.XSize, 1, gdal.GDT_Float32)
-                bqa_tuple = struct.unpack('f' * bqa_band.XSize, bqa_scanline)
-
-                for i in range(len(red_tuple)):
-                    if bqa_tuple[i] in bqa_values:
-                        ndvi = 0
-                    elif b6_tuple[i] < 0.1:
-                        ndvi = 0
-                    else:
-                        ndvi_lower = (nir_tuple[i] + red_tuple[i])
-                        ndvi_upper = (nir_tuple[i] - red_tuple[i])
-                        ndvi = 0
-                        if ndvi_lower == 0:
-                            ndvi = 0
-                        else:
-                            ndvi = ndvi_upper / ndvi_lower
-
-                    outputLine = outputLine + struct.pack('f', ndvi)
-
-                outDataset.GetRasterBand(1).WriteRaster(0, line, red_band.XSize,
-                    1, outputLine, buf_xsize=red_band.XSize, buf_ysize=1,
-                    buf_type=gdal.GDT_Float32)
-                del outputLine
+            masked = new_buffer(reader.windows, numpy.bool_)
+            with BlockWriter(outDataset.GetRasterBand(1), reader.windows,
+                    queue_depth=self.queue_depth) as writer:
+                for window, (red, nir, b6_block, bqa_block) in reader:
+                    ndvi = writer.get_buffer(window)
+                    calc_ndvi(red, nir, b6_block, bqa_block, ndvi,
+                        window_view(masked, window))
+                    writer.write(window, ndvi)
+            outDataset = None
 
             #remove toa files
             for toa in [self.b4_toa, self.b5_toa, self.b6_toa]:
@@ -247,74 +354,46 @@ class Process(object):
                 print('NDVI could not be created')
                 return False
 
-    def change_detection(self, polygonize=False):
+    def change_detection(self, polygonize=False, stats=None, zones=None,
+            zone_field=None):
         """The process of change detection involves the following steps:
             1. Warp NDVI images if it has differents coordinates and resolutions
-            2. Subtract NDVI images
-            3. Mask the image generated by the subtract, putting the value 1
-                where the pixel value is less than -0.08 and putting the value
-                0 in the others pixels
-            4. Sieve the image, removing areas lower than 33 pixels
+            2. Subtract NDVI images and mask the result in a single pass,
+                putting the value 1 where the difference is less than -0.08
+                and the value 0 in the others pixels
+            3. Sieve the image, removing areas lower than 33 pixels
+            4. If stats is 'csv' or 'json', write the statistics of each area
+                of change, aggregated by the optional zones raster or polygon
+                layer, whose polygons are identified by zone_field
             5. If polygonize is true:
                 5.1 Polygonize the sieve image creating a Shapefile
                 5.2 Convert the Shapefile to GeoJSON reprojecting it to Sirgas 2000
         """
 
         last_image = get_last_image_name(self.image)
-        last_ndvi = os.path.join(self.src_image_path.replace(self.image, ''),
-            last_image, last_image + '_ndvi.tif')
+        last_ndvi = self.get_last_ndvi()
 
         if os.path.isfile(self.ndvi) and os.path.isfile(last_ndvi):
             ndvi_warp = os.path.join(self.src_image_path,
                 self.image + '_ndvi_warp.tif')
             last_ndvi_warp = os.path.join(self.src_image_path.replace(self.image, ''),
                 last_image, last_image + '_ndvi_warp.tif')
-            changes = os.path.join(self.src_image_path,
-                self.image + '_changes.tif')
-            changes_mask = os.path.join(self.src_image_path,
-                self.image + '_changes_mask.tif')
-            sieve = os.path.join(self.src_image_path,
-                self.image + '_detection.tif')
 
             # verify if the images has different coordinates, if yes, warp them
             if get_image_bounds(self.ndvi) != get_image_bounds(last_ndvi):
                 bounds = get_intersection_bounds(self.ndvi, last_ndvi)
                 warp_image(self.ndvi, bounds, ndvi_warp)
                 warp_image(last_ndvi, bounds, last_ndvi_warp)
-                subtract(ndvi_warp, last_ndvi_warp, changes)
+                result_file = detect_changes([ndvi_warp], [last_ndvi_warp],
+                    self.src_image_path, self.image, polygonize,
+                    self.queue_depth, stats, zones, zone_field)
             else:
-                subtract(self.ndvi, last_ndvi, changes)
-
-            mask_image(changes, -0.08, changes_mask)
-            # remove areas lower than 33 pixels what represents 30000 sq metres
-            call(['gdal_sieve.py', '-st', '33', changes_mask, sieve])
-            result_file = sieve
-
-            if polygonize is True:
-                # create a folder to shp files because it's more than one file
-                detection_shp = os.path.join(
-                    check_create_folder(os.path.join(self.src_image_path, 'shp')),
-                    self.image + '_detection.shp')
-                detection_geojson = os.path.join(self.src_image_path,
-                    self.image + '_detection.geojson')
-
-                # polygonize sieve file to shapefile
-                call(['gdal_polygonize.py', sieve, '-f', 'ESRI Shapefile',
-                    detection_shp])
-                # convert to GeoJSON, reproject in Sirgas 2000 and filter areas
-                # with DN=1 to get only the areas where the pixel had
-                # value 1 in the changes_mask
-                call(['ogr2ogr', '-where', '"DN"=1', '-t_srs', 'EPSG:4674',
-                    '-f', 'GeoJSON', detection_geojson, detection_shp])
-                os.remove(sieve)
-                result_file = detection_geojson
-
-                # remove shp folder
-                rmtree(os.path.join(self.src_image_path, 'shp'))
-
-            # remove intermediate files
-            file_list = [ndvi_warp, last_ndvi_warp, changes, changes_mask]
-            for f in file_list:
+                result_file = detect_changes([self.ndvi], [last_ndvi],
+                    self.src_image_path, self.image, polygonize,
+                    self.queue_depth, stats, zones, zone_field)
+
+            # remove warped files
+            for f in [ndvi_warp, last_ndvi_warp]:
                 if os.path.isfile(f):
                     os.remove(f)
 
@@ -324,6 +403,87 @@ class Process(object):
             print('Change detection was not executed because some NDVI image is missing.')
             return False
 
+    def preview(self, factor, bands=[6, 5, 4]):
+        """Make a quick look of the image at 1/factor of its resolution,
+        reading the bands with decimation or from their overviews. It creates
+        an image composition PNG, a NDVI GeoTIFF and PNG and, if there is a
+        NDVI of 16 days ago (preview or not), a change detection GeoTIFF and
+        PNG with the same TOA Reflectance, NDVI and threshold used in the full
+        resolution processing. The change detection is not sieved.
+        """
+        if not os.path.isfile(self.mtl):
+            print('Could not make the preview because MTL file was not found')
+            return False
+
+        band_path = os.path.join(self.src_image_path, self.image + '_B%s.TIF')
+        name = os.path.join(self.src_image_path, self.image)
+        created = []
+
+        # each band is read once, the bands 4, 5 and 6 are used by the
+        # composition as DN and then converted to TOA Reflectance in place
+        data = {}
+        for band in list(bands) + [4, 5, 6]:
+            if band not in data:
+                data[band], gt, projection = read_decimated(band_path % band,
+                    factor, numpy.float64)
+        arrays = [stretch(data[band]) for band in bands]
+        composition = name + '_r%sg%sb%s_preview.png' % tuple(bands)
+        write_raster(arrays, gt, projection, composition, 'PNG')
+        created.append(composition)
+
+        image = Landsat8(self.mtl)
+        image.getGain()
+        image.getSolarAngle()
+        toa = []
+        for band in [4, 5, 6]:
+            image.reflectance(band - 1, data[band])
+            # saturated pixels
+            numpy.minimum(data[band], 1, out=data[band])
+            toa.append(data[band])
+        bqa = read_decimated(self.bqa, factor, numpy.uint16)[0]
+        mask = numpy.empty(bqa.shape, numpy.bool_)
+        ndvi = numpy.empty(bqa.shape, numpy.float32)
+        calc_ndvi(toa[0], toa[1], toa[2], bqa, ndvi, mask)
+
+        ndvi_preview = name + '_ndvi_preview.tif'
+        write_raster([ndvi], gt, projection, ndvi_preview)
+        ndvi_png = ((ndvi + 1) * 127.5).clip(1, 255).astype(numpy.uint8)
+        ndvi_png[ndvi == 0] = 0
+        write_raster([ndvi_png], gt, projection, name + '_ndvi_preview.png', 'PNG')
+        created += [ndvi_preview, name + '_ndvi_preview.png']
+
+        last_ndvi = self.get_last_ndvi()
+        last_files = [last_ndvi.replace('_ndvi.tif', '_ndvi_preview.tif'),
+            last_ndvi]
+        last_files = [f for f in last_files if os.path.isfile(f)]
+        if last_files:
+            last = read_resampled(last_files[0], gt, projection, ndvi.shape)
+            changes = numpy.empty(ndvi.shape, numpy.float32)
+            calc_difference(ndvi, last, changes, mask)
+            detection = numpy.less_equal(changes, -0.08).astype(numpy.uint8)
+            write_raster([detection], gt, projection,
+                name + '_detection_preview.tif')
+            write_raster([detection * 255], gt, projection,
+                name + '_detection_preview.png', 'PNG')
+            created += [name + '_detection_preview.tif',
+                name + '_detection_preview.png']
+        else:
+            print('Change detection preview was not created because the last NDVI image is missing.')
+
+        print('Preview created in %s' % ', '.join(created))
+        return created
+
+    def get_metadata(self):
+        """Return a dict with the fields of the MTL file or None if it's
+        missing.
+        """
+        return get_metadata(self.src_image_path)
+
+    def get_last_ndvi(self):
+        """Return the path of the NDVI of the same scene 16 days ago."""
+        last_image = get_last_image_name(self.image)
+        return os.path.join(self.src_image_path.replace(self.image, ''),
+            last_image, last_image + '_ndvi.tif')
 
     def make_ref_toa(self):
         """Convert the bands 4, 5 and 6 from Spot DN to Top of Atmosphere (TOA)
@@ -337,10 +497,10 @@ class Process(object):
             image = Landsat8(self.mtl)
             image.getGain()
             image.getSolarAngle()
-            image.getSolarIrrad()
             image.reflectanceToa([self.b4, self.b5, self.b6],
                 outname='_toa.tif',
-                outpath=self.src_image_path)
+                outpath=self.src_image_path,
+                queue_depth=self.queue_depth)
         else:
             print("""Could not make TOA Reflectance images because MTL file
                 was not found""")
@@ -27,6 +27,9 @@ import glob
 from osgeo import gdal
 from osgeo.gdalconst import *
 
+from .blocks import BlockReader, BlockWriter, QUEUE_DEPTH
+from .mtl import flatten, read_mtl
+
 
 # Class Landsat 8 (LDCM)
 class Landsat8:
@@ -37,17 +40,9 @@ class Landsat8:
         """
         print('metadata filename: %s' % (metafile))
         startTime = time.time()
-        meta = open(metafile, 'r')
-        metalines = meta.readlines()
-        self.root = {}
-        for line in metalines:
-            if any(i in line for i in ('REFLECTANCE_MULT_BAND_',
-                                        'REFLECTANCE_ADD_BAND_',
-                                        'K1_CONSTANT_BAND_', 'K2_CONSTANT_BAND_',
-                                        'SUN_AZIMUTH', 'SUN_ELEVATION')):
-                self.root[line.split('=')[0].strip()] = float(line.split('=')[1].strip())
-        metalines = None
-        meta.close()
+        # hierarchical metadata and the fields of all groups
+        self.metadata = read_mtl(metafile)
+        self.root = flatten(self.metadata)
         endTime = time.time()
         print('parsing duration: %s seconds' % (endTime - startTime))
 
@@ -71,12 +66,35 @@ class Landsat8:
         self.bandList = glob.glob(os.path.join(dirname, 'LC*B[1-9].TIF'))
 
     def getDistEarthSun(self):
-        self.distEarthSun = 'not required'
+        """
+        Earth-Sun distance in astronomical units
+        """
+        self.distEarthSun = self.root['EARTH_SUN_DISTANCE']
 
     def getSolarIrrad(self):
-        self.eSun = ['not required']
+        """
+        List of Landsat band-specific exoatmospheric solar irradiance (ESUN),
+        derived from the maximum radiance and reflectance of each band:
+        ESUN = (pi * d^2) * RADIANCE_MAXIMUM / REFLECTANCE_MAXIMUM
+        (coastal/aerosol, blue, green, red, nir, swir1, swir2, pan, cirrus)
+        """
+        self.getDistEarthSun()
+        self.eSun = [numpy.pi * self.distEarthSun ** 2 *
+                     self.root['RADIANCE_MAXIMUM_BAND_%s' % (i+1)] /
+                     self.root['REFLECTANCE_MAXIMUM_BAND_%s' % (i+1)]
+                     for i in range(9)]
+
+    def reflectance(self, band, data, maxi=1):
+        """
+        TOA Reflectance of the band, computed in place in the data array
+        """
+        numpy.multiply(data, self.gain[band], out=data)
+        numpy.add(data, self.add[band], out=data)
+        numpy.multiply(data, maxi / numpy.cos(numpy.radians(self.solarZAngle)),
+                       out=data)
 
-    def reflectanceToa(self, bandList, outname='refToa.tif', bitcode='32', outpath=None):
+    def reflectanceToa(self, bandList, outname='refToa.tif', bitcode='32', outpath=None,
+                       queue_depth=QUEUE_DEPTH):
         """
         TOA Reflectance
         Equation for Landsat 8:
@@ -86,6 +104,7 @@ class Landsat8:
              CN for pixel value (digital number)
              A for Band-specific additive rescaling factor
              thZ for Solar Zenithal angle
+        queue_depth is the number of windows read ahead and written behind
         """
         startTime = time.time()
         # image driver
@@ -101,16 +120,14 @@ class Landsat8:
             if inDs is None:
                 print('could not open %s' % imgfile)
                 sys.exit(1)
-            # image size and tiles
+            # image size
             cols = inDs.RasterXSize
             rows = inDs.RasterYSize
             bands = inDs.RasterCount
-            xBSize = 60
-            yBSize = 60
             # output image name
             if bitcode == '32':
                 codage = GDT_Float32
-                nptype = numpy.float
+                nptype = numpy.float32
                 maxi = 1
             elif bitcode == '16':
                 codage = GDT_UInt16
@@ -129,27 +146,18 @@ class Landsat8:
 
             outBand = outDs.GetRasterBand(1)
             canal = inDs.GetRasterBand(1)
-            # line search
-            for i in range(0, rows, yBSize):
-                if i + yBSize < rows:
-                    numRows = yBSize
-                else:
-                    numRows = rows - i
-                # column search
-                for j in range(0, cols, xBSize):
-                    if j + xBSize < cols:
-                        numCols = xBSize
-                    else:
-                        numCols = cols - j
-                    data = canal.ReadAsArray(j, i, numCols, numRows).astype(numpy.float)
+            # native block search
+            reader = BlockReader([canal], numpy.float64, queue_depth=queue_depth)
+            with BlockWriter(outBand, reader.windows, nptype,
+                    queue_depth) as writer:
+                for window, (data,) in reader:
                     # TOA Reflectance with correction for sun angle
-                    toa = (maxi * (self.gain[band] * data + self.add[band]) /
-                           (numpy.cos(numpy.radians(self.solarZAngle)))
-                           ).astype(nptype)
+                    self.reflectance(band, data, maxi)
+                    toa = writer.get_buffer(window)
+                    numpy.copyto(toa, data, casting='unsafe')
                     # saturated pixels (> 1 or > 1000)
-                    mask = numpy.less_equal(toa, maxi)
-                    toa = numpy.choose(mask, (maxi, toa))
-                    outBand.WriteArray(toa, j, i)
+                    numpy.minimum(toa, maxi, out=toa)
+                    writer.write(window, toa)
             outBand.FlushCache()
             stats = outBand.GetStatistics(0, 1)
             outBand = None
@@ -0,0 +1,333 @@
+# Indicar Landsat Geoprocessing Tools
+#
+#
+# Author: Hex Gis
+# Contributor: willemarcel
+#
+# License: GPLv3
+
+from __future__ import print_function
+from subprocess import call
+import csv
+import json
+import os
+import sys
+
+import numpy
+from osgeo import gdal, ogr
+
+from .blocks import BlockReader, QUEUE_DEPTH, strip_windows
+
+
+COMPONENT_FIELDS = ['id', 'pixels', 'area_ha', 'minx', 'miny', 'maxx', 'maxy',
+    'centroid_x', 'centroid_y']
+
+ZONE_FIELDS = ['zone', 'components', 'pixels', 'area_ha']
+
+
+class Components(object):
+
+    def __init__(self, connectivity=4):
+        """Label the connected components of a raster read line by line from
+        top to bottom, keeping only the runs of the last line and the
+        statistics of each label.
+
+        Arguments:
+        connectivity - 4 or 8, the pixel neighbourhood used to connect pixels
+
+        """
+        self.touch = 1 if connectivity == 8 else 0
+        self.parent = []
+        self.pixels = []
+        self.bounds = []
+        self.sums = []
+        self.zones = []
+        self.previous = []
+        self.previous_line = None
+        self.padded = None
+
+    def find(self, label):
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def union(self, label1, label2):
+        label1 = self.find(label1)
+        label2 = self.find(label2)
+        if label1 != label2:
+            self.parent[max(label1, label2)] = min(label1, label2)
+        return min(label1, label2)
+
+    def add_run(self, label, line, start, end):
+        """Add the pixels from start to end - 1 of the line to the label."""
+        if label is None:
+            label = len(self.parent)
+            self.parent.append(label)
+            self.pixels.append(0)
+            self.bounds.append([start, line, end, line + 1])
+            self.sums.append([0, 0])
+            self.zones.append({})
+        count = end - start
+        bounds = self.bounds[label]
+        bounds[0] = min(bounds[0], start)
+        bounds[2] = max(bounds[2], end)
+        bounds[3] = line + 1
+        self.pixels[label] += count
+        self.sums[label][0] += (start + end - 1) * count / 2.0
+        self.sums[label][1] += line * count
+        return label
+
+    def add_line(self, line, starts, ends):
+        """Label the runs of a line, connecting them to the runs of the
+        previous line. Return the runs as (start, end, label) tuples.
+        """
+        if self.previous_line == line - 1:
+            previous = self.previous
+        else:
+            previous = []
+        runs = []
+        i = 0
+        for start, end in zip(starts, ends):
+            start = int(start)
+            end = int(end)
+            # skip the runs of the previous line that end before this run
+            while i < len(previous) and previous[i][1] + self.touch <= start:
+                i += 1
+            label = None
+            j = i
+            while j < len(previous) and previous[j][0] < end + self.touch:
+                if label is None:
+                    label = self.find(previous[j][2])
+                else:
+                    label = self.union(label, previous[j][2])
+                j += 1
+            runs.append((start, end, self.add_run(label, line, start, end)))
+        self.previous = runs
+        self.previous_line = line
+        return runs
+
+    def add_strip(self, yoff, block, zone_block=None):
+        """Label the lines of a strip as wide as the raster. Nonzero pixels
+        belong to the components. If zone_block is given, the pixels of
+        each label are counted by zone.
+        """
+        lines, cols = block.shape
+        if self.padded is None or self.padded.shape[0] < lines:
+            # runs start where the difference is 1 and end where it is -1
+            self.padded = numpy.zeros((lines, cols + 2), numpy.int8)
+        padded = self.padded[:lines]
+        numpy.not_equal(block, 0, out=padded[:, 1:cols + 1])
+        diff = numpy.diff(padded, axis=1)
+        run_lines, starts = numpy.nonzero(diff == 1)
+        ends = numpy.nonzero(diff == -1)[1]
+        limits = numpy.searchsorted(run_lines, numpy.arange(lines + 1))
+
+        if zone_block is not None:
+            labels = numpy.zeros((lines, cols), numpy.int64)
+        for line in range(lines):
+            first, last = limits[line], limits[line + 1]
+            runs = self.add_line(yoff + line, starts[first:last],
+                ends[first:last])
+            if zone_block is not None:
+                for start, end, label in runs:
+                    labels[line, start:end] = label
+
+        if zone_block is not None and len(starts):
+            selected = padded[:, 1:cols + 1] != 0
+            keys = (labels[selected] << 32) | (
+                zone_block[selected].astype(numpy.int64) & 0xffffffff)
+            keys, counts = numpy.unique(keys, return_counts=True)
+            for key, count in zip(keys, counts):
+                label = int(key >> 32)
+                zone = int(key & 0xffffffff)
+                if zone >= 2 ** 31:
+                    zone -= 2 ** 32
+                zones = self.zones[label]
+                zones[zone] = zones.get(zone, 0) + int(count)
+
+    def statistics(self):
+        """Return a list with the pixel count, the pixel bounds
+        (minx, miny, maxx, maxy), the pixel centroid and the pixel count by
+        zone of each component, ordered from top to bottom.
+        """
+        components = {}
+        order = []
+        for label in range(len(self.parent)):
+            root = self.find(label)
+            if root not in components:
+                components[root] = {'pixels': 0, 'bounds': list(self.bounds[label]),
+                    'sums': [0, 0], 'zones': {}}
+                order.append(root)
+            component = components[root]
+            bounds = self.bounds[label]
+            component['pixels'] += self.pixels[label]
+            component['bounds'] = [min(component['bounds'][0], bounds[0]),
+                min(component['bounds'][1], bounds[1]),
+                max(component['bounds'][2], bounds[2]),
+                max(component['bounds'][3], bounds[3])]
+            component['sums'][0] += self.sums[label][0]
+            component['sums'][1] += self.sums[label][1]
+            for zone, count in self.zones[label].items():
+                component['zones'][zone] = component['zones'].get(zone, 0) + count
+
+        result = []
+        for root in order:
+            component = components[root]
+            component['centroid'] = (
+                component['sums'][0] / component['pixels'] + 0.5,
+                component['sums'][1] / component['pixels'] + 0.5)
+            del component['sums']
+            result.append(component)
+        return result
+
+
+def prepare_zones(zones, zone_field, image, output_file):
+    """Return the path of a zone raster with the same grid of the image. If
+    zones is a raster with the same grid, it's returned unchanged. Rasters
+    with other grids are warped and polygon layers are rasterized, burning
+    the integer zone_field, in output_file.
+    """
+    zone_ds = gdal.Open(zones, gdal.GA_ReadOnly)
+    gt = image.GetGeoTransform()
+
+    if zone_ds is not None and zone_ds.RasterCount > 0:
+        if (zone_ds.RasterXSize == image.RasterXSize and
+                zone_ds.RasterYSize == image.RasterYSize and
+                zone_ds.GetGeoTransform() == gt):
+            return zones
+        bounds = [gt[0], gt[3] + image.RasterYSize * gt[5],
+            gt[0] + image.RasterXSize * gt[1], gt[3]]
+        call(['gdalwarp', '-q', '-r', 'near', '-t_srs', image.GetProjection(),
+            '-te'] + ['%s' % i for i in bounds] +
+            ['-ts', '%s' % image.RasterXSize, '%s' % image.RasterYSize,
+            zones, output_file])
+        return output_file
+
+    vector = ogr.Open(zones)
+    if vector is None:
+        print('The zones could not be opened')
+        sys.exit(-1)
+    if not zone_field:
+        print('The zone field is required to use a polygon layer as zones')
+        sys.exit(-1)
+
+    driver = gdal.GetDriverByName('GTiff')
+    zone_ds = driver.Create(output_file, image.RasterXSize, image.RasterYSize,
+        1, gdal.GDT_Int32, ['COMPRESS=LZW'])
+    zone_ds.SetGeoTransform(gt)
+    zone_ds.SetProjection(image.GetProjection())
+    gdal.RasterizeLayer(zone_ds, [1], vector.GetLayer(),
+        options=['ATTRIBUTE=%s' % zone_field])
+    zone_ds = None
+
+    return output_file
+
+
+def write_statistics(components, zones, output_file):
+    """Write the components and zones to output_file. If its extension is
+    .json, a JSON object with both lists is written. Otherwise, the
+    components are written as CSV and the zones in a second CSV file with the
+    _zones suffix.
+    """
+    fields = COMPONENT_FIELDS + (['zone'] if zones is not None else [])
+    if output_file.lower().endswith('.json'):
+        result = {'components': components}
+        if zones is not None:
+            result['zones'] = zones
+        with open(output_file, 'w') as f:
+            json.dump(result, f, indent=2)
+        return
+
+    tables = [(output_file, fields, components)]
+    if zones is not None:
+        zones_file = '%s_zones%s' % os.path.splitext(output_file)
+        tables.append((zones_file, ZONE_FIELDS, zones))
+    for path, fieldnames, rows in tables:
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def change_statistics(detection, output_file, zones=None, zone_field=None,
+        connectivity=4, queue_depth=QUEUE_DEPTH):
+    """Label the connected areas of change of the detection raster and write
+    the pixel count, area in hectares, bounding box and centroid of each one
+    to output_file, as CSV or JSON depending on its extension. The raster is
+    read in strips, so no polygon is created.
+
+    zones is an optional raster or polygon layer used to aggregate the areas.
+    Each area is assigned to the zone that contains most of its pixels and the
+    pixels of each zone are summed. Polygon layers are rasterized using the
+    integer zone_field. Zone 0 means outside of any zone and is not listed in
+    the zones summary. connectivity is 4 or 8, the default 4 is the same used
+    by gdal_sieve and gdal_polygonize.
+    """
+    image = gdal.Open(detection, gdal.GA_ReadOnly)
+
+    if image is None:
+        print('The image could not be opened')
+        sys.exit(-1)
+
+    band = image.GetRasterBand(1)
+    bands = [band]
+    dtypes = [numpy.uint8]
+    zone_file = None
+    if zones:
+        zone_file = '%s_zones.tif' % os.path.splitext(output_file)[0]
+        zone_ds = gdal.Open(prepare_zones(zones, zone_field, image, zone_file),
+            gdal.GA_ReadOnly)
+        bands.append(zone_ds.GetRasterBand(1))
+        dtypes.append(numpy.int32)
+
+    labeler = Components(connectivity)
+    reader = BlockReader(bands, dtypes, strip_windows(band), queue_depth)
+    for window, blocks in reader:
+        labeler.add_strip(window[1], *blocks)
+
+    gt = image.GetGeoTransform()
+    pixel_area = abs(gt[1] * gt[5] - gt[2] * gt[4]) / 10000.0
+
+    def to_map(x, y):
+        return (gt[0] + x * gt[1] + y * gt[2], gt[3] + x * gt[4] + y * gt[5])
+
+    components = []
+    zone_summary = {}
+    for i, component in enumerate(labeler.statistics()):
+        minx, miny, maxx, maxy = component['bounds']
+        corners = [to_map(x, y) for x in (minx, maxx) for y in (miny, maxy)]
+        centroid = to_map(*component['centroid'])
+        row = {'id': i + 1,
+            'pixels': component['pixels'],
+            'area_ha': round(component['pixels'] * pixel_area, 4),
+            'minx': min(c[0] for c in corners),
+            'miny': min(c[1] for c in corners),
+            'maxx': max(c[0] for c in corners),
+            'maxy': max(c[1] for c in corners),
+            'centroid_x': centroid[0],
+            'centroid_y': centroid[1]}
+        if zones:
+            counts = component['zones']
+            row['zone'] = max(counts, key=counts.get) if counts else 0
+            for zone, count in counts.items():
+                summary = zone_summary.setdefault(zone, [0, 0])
+                summary[1] += count
+            zone_summary.setdefault(row['zone'], [0, 0])[0] += 1
+        components.append(row)
+
+    zone_rows = None
+    if zones:
+        zone_rows = [{'zone': zone, 'components': summary[0],
+            'pixels': summary[1], 'area_ha': round(summary[1] * pixel_area, 4)}
+            for zone, summary in sorted(zone_summary.items()) if zone != 0]
+        zone_ds = None
+        if zone_file and os.path.isfile(zone_file):
+            os.remove(zone_file)
+
+    write_statistics(components, zone_rows, output_file)
+
+    print('Change statistics created in %s' % output_file)
+    return output_file
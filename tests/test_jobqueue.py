@@ -0,0 +1,165 @@
+# Indicar Landsat Geoprocessing Tools
+#
+#
+# Author: Hex Gis
+# Contributor: willemarcel
+#
+# License: GPLv3
+
+from multiprocessing import Process as WorkerProcess
+import os
+import time
+
+import numpy
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+from osgeo import osr
+
+from indicar.jobqueue import JobQueue, Worker
+
+
+SIZE = 128
+
+# the previous scene and the scene of 16 days later, where a square of
+# 12 x 12 pixels lost its vegetation
+LAST_IMAGE = 'LC82240632015001LGN00'
+IMAGE = 'LC82240632015017LGN00'
+CHANGE = (slice(40, 52), slice(60, 72))
+
+MTL = """GROUP = L1_METADATA_FILE
+  GROUP = IMAGE_ATTRIBUTES
+    SUN_AZIMUTH = 120.0
+    SUN_ELEVATION = 90.0
+    EARTH_SUN_DISTANCE = 1.0
+  END_GROUP = IMAGE_ATTRIBUTES
+  GROUP = MIN_MAX_RADIANCE
+%s
+  END_GROUP = MIN_MAX_RADIANCE
+  GROUP = MIN_MAX_REFLECTANCE
+%s
+  END_GROUP = MIN_MAX_REFLECTANCE
+  GROUP = RADIOMETRIC_RESCALING
+%s
+  END_GROUP = RADIOMETRIC_RESCALING
+END_GROUP = L1_METADATA_FILE
+END
+"""
+
+
+def write_mtl(path):
+    bands = range(1, 10)
+    radiance = '\n'.join('    RADIANCE_MAXIMUM_BAND_%s = 700.0' % i
+        for i in bands)
+    reflectance = '\n'.join('    REFLECTANCE_MAXIMUM_BAND_%s = 1.2107' % i
+        for i in bands)
+    rescaling = '\n'.join('    REFLECTANCE_MULT_BAND_%s = 2.0000E-05\n'
+        '    REFLECTANCE_ADD_BAND_%s = -0.100000' % (i, i) for i in bands)
+    with open(path, 'w') as f:
+        f.write(MTL % (radiance, reflectance, rescaling))
+
+
+def write_band(path, data):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32722)
+    dataset = gdal.GetDriverByName('GTiff').Create(path, SIZE, SIZE, 1,
+        gdal.GDT_UInt16)
+    dataset.SetGeoTransform([500000, 30, 0, 9000000, 0, -30])
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(data)
+    dataset = None
+
+
+def make_scene(folder, image, changed):
+    """Create the bands 4, 5, 6 and BQA and the MTL of a fake scene, with
+    reflectances 0.1 in the red and 0.4 in the near infrared (NDVI 0.6). If
+    changed is True, the near infrared of the CHANGE area is 0.15 (NDVI 0.2).
+    """
+    scene = os.path.join(folder, image)
+    os.makedirs(scene)
+    nir = numpy.full((SIZE, SIZE), 25000, numpy.uint16)
+    if changed:
+        nir[CHANGE] = 12500
+    bands = {'B4': numpy.full((SIZE, SIZE), 10000, numpy.uint16),
+        'B5': nir,
+        'B6': numpy.full((SIZE, SIZE), 15000, numpy.uint16),
+        'BQA': numpy.zeros((SIZE, SIZE), numpy.uint16)}
+    for band, data in bands.items():
+        write_band(os.path.join(scene, '%s_%s.TIF' % (image, band)), data)
+    write_mtl(os.path.join(scene, image + '_MTL.txt'))
+    return scene
+
+
+def run_worker(queue_path, worker_id):
+    Worker(queue_path, worker_id, heartbeat=1, poll=0.2).run()
+
+
+def test_claim_job_waiting_more_than_timeout(tmpdir):
+    queue = JobQueue(str(tmpdir.join('queue')))
+    queue.submit([str(tmpdir.join(IMAGE))])
+    # submitted 20 minutes ago, more than STALE_TIMEOUT
+    submitted = time.time() - 1200
+    os.utime(queue.job_file('pending', IMAGE), (submitted, submitted))
+
+    job, running = queue.claim('worker1')
+    assert job['id'] == IMAGE
+    # the detection job waits for the scene and the claimed job isn't stale
+    assert queue.claim('worker2') is None
+    assert os.path.isfile(running)
+    assert queue.list('running') == [IMAGE]
+
+
+def test_job_moving_between_folders_is_not_absent(tmpdir):
+    queue = JobQueue(str(tmpdir.join('queue')))
+    queue.submit([str(tmpdir.join(IMAGE))])
+    job = {'requires': [IMAGE, LAST_IMAGE]}
+    assert not queue.is_ready(job)
+
+    # the scene job is found in no folder while it's renamed
+    pending = queue.job_file('pending', IMAGE)
+    moving = str(tmpdir.join('moving.json'))
+    os.rename(pending, moving)
+    assert queue.state(IMAGE) is None
+    assert not queue.is_ready(job)
+
+    os.rename(moving, queue.job_file('done', IMAGE))
+    assert queue.is_ready(job)
+
+
+def test_workers(tmpdir):
+    scenes = str(tmpdir.mkdir('scenes'))
+    queue_path = str(tmpdir.join('queue'))
+    last_scene = make_scene(scenes, LAST_IMAGE, False)
+    scene = make_scene(scenes, IMAGE, True)
+
+    queue = JobQueue(queue_path)
+    submitted = queue.submit([scene, last_scene])
+    assert sorted(submitted) == [LAST_IMAGE, LAST_IMAGE + '_detection',
+        IMAGE, IMAGE + '_detection']
+
+    workers = [WorkerProcess(target=run_worker,
+        args=(queue_path, 'worker%s' % i)) for i in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(300)
+        assert worker.exitcode == 0
+
+    # each job ran once and the scene of 16 days before has no previous
+    # NDVI, so only its detection fails
+    assert queue.list('pending') == []
+    assert queue.list('running') == []
+    assert queue.list('done') == [LAST_IMAGE, IMAGE, IMAGE + '_detection']
+    assert queue.list('failed') == [LAST_IMAGE + '_detection']
+    assert os.listdir(os.path.join(queue_path, 'staging')) == []
+
+    for folder, image in [(last_scene, LAST_IMAGE), (scene, IMAGE)]:
+        assert os.path.isfile(os.path.join(folder, image + '_ndvi.tif'))
+        assert os.path.isfile(os.path.join(folder, image + '_r6g5b4.tif'))
+
+    detection = gdal.Open(os.path.join(scene, IMAGE + '_detection.tif'))
+    assert detection is not None
+    result = detection.GetRasterBand(1).ReadAsArray()
+    expected = numpy.zeros((SIZE, SIZE), numpy.uint8)
+    expected[CHANGE] = 1
+    assert (result == expected).all()